@@ -4,28 +4,46 @@ import configparser
 import logging
 import difflib
 import hashlib
+import json
+import shutil
+import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator
 
 class easyGit:
     def __init__(self) -> None:
         # Get current path & repository path
         self.currentPath = os.getcwd()
-        self.repoPath = getRepositoryPath(convertToPath(self.currentPath))
+        self.repoPath = getRepositoryPath(self.currentPath)
 
         # Return if repository doe not exist
         if self.repoPath is None:
             print("Could not find repository folder, exiting...")
             return
 
-        # Get folders' paths
-        self.projectFolderPath = convertToPath(os.path.dirname(self.repoPath))
-        self.commitFolderPath = convertToPath(os.path.join(self.repoPath, "commit"))
-        self.changeFolderPath = convertToPath(os.path.join(self.repoPath, "changes"))
+        # Get folders' paths, all of them are built from the absolute repository path
+        self.projectFolderPath = os.path.dirname(self.repoPath)
+        self.commitFolderPath = os.path.join(self.repoPath, "commit")
+        self.changeFolderPath = os.path.join(self.repoPath, "changes")
 
         # Get files' paths
-        self.logFile = convertToPath(os.path.join(self.repoPath, "log", "log.log"))
-        self.headFile = convertToPath(os.path.join(self.repoPath, "commit", "HEAD"))
+        self.logFile = os.path.join(self.repoPath, "log", "log.log")
+        self.headFile = os.path.join(self.repoPath, "commit", "HEAD")
+        self.hashCacheFile = os.path.join(self.repoPath, "hashcache")
+
+        # Read hash cache, {file path: [mtime in ns, ctime in ns, inode, size, SHA]}
+        self.hashCache = {}
+        self.hashCacheTime = 0 # Entries modified at or after this are racy, see commit
+        if os.path.exists(self.hashCacheFile):
+            self.hashCacheTime = os.stat(self.hashCacheFile).st_mtime_ns
+            with open(self.hashCacheFile, "r", encoding = "utf-8") as hashCacheIO:
+                try:
+                    self.hashCache = json.load(hashCacheIO)
+                except json.JSONDecodeError:
+                    pass # Rebuilt by the next commit
 
         # Read configuration
         self.config = configparser.ConfigParser()
@@ -42,34 +60,33 @@ class easyGit:
 
         self.logger = logging.getLogger("easygit")
         self.logger.setLevel(loggingLevel)
-        self.logger.addHandler(logging.FileHandler(self.logFile))
+        fileHandler = logging.FileHandler(self.logFile)
+        fileHandler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", datefmt = "%Y%m%d %H-%M-%S"))
+        self.logger.addHandler(fileHandler)
 
     def add(self, targetFilenames: list[str]) -> None:
         """Add file(s) to the staging area"""
-        def getAllChildFiles(__targetFolderPath__: os.PathLike) -> list[os.PathLike]:
-            filePaths = []
-            for path in os.listdir(__targetFolderPath__):
-                item = os.path.join(__targetFolderPath__, path)
-                if os.path.isfile(item):
-                    filePaths.append(item)
-                    self.logger.debug(f"[{getTime()}] File located: {item}")
-                elif os.path.isdir(item) and item != os.path.join(__targetFolderPath__, ".easygit"):
-                    filePaths.extend(getAllChildFiles(item))
-            return filePaths
-
-        self.logger.debug(f"[{getTime()}] function add executed")
+        self.logger.debug("function add executed")
 
         # Get path(s)
         if "." in targetFilenames:
-            filePaths = getAllChildFiles(self.currentPath)
+            # The walk only skips .easygit folders below the current folder
+            if isRepositoryPath(self.currentPath):
+                self.logger.error("Cannot add files inside the repository folder, exiting...")
+                return
+            filePaths = list(getAllChildFiles(self.currentPath))
+            self.logger.debug("Located %d file(s)", len(filePaths))
         else:
             filePaths = []
             for filename in targetFilenames:
                 currentFilePath = convertToPath(filename)
                 if currentFilePath is None:
-                    self.logger.warning(f"[{getTime()}] Cannot find file: {currentFilePath}, ignoring...")
+                    self.logger.warning("Cannot find file: %s, ignoring...", filename)
+                    continue
+                if isRepositoryPath(currentFilePath):
+                    self.logger.warning("Cannot add repository file: %s, ignoring...", currentFilePath)
                     continue
-                self.logger.debug(f"[{getTime()}] Added file: {currentFilePath}")
+                self.logger.debug("Added file: %s", currentFilePath)
                 filePaths.append(currentFilePath)
 
         # Get staging area file
@@ -78,127 +95,153 @@ class easyGit:
         # Merge paths
         if os.path.exists(stagingFilePath):
             with open(stagingFilePath, "r", encoding = "utf-8") as stagingFileIO:
-                mergedFilePaths = set(filePaths)
-                for f in stagingFileIO.readlines():
-                    mergedFilePaths.add(f.strip("\n"))
+                mergedFilePaths = {f.rstrip("\n") for f in stagingFileIO}
         else:
-            mergedFilePaths = set(filePaths)
+            mergedFilePaths = set()
+        mergedFilePaths.update(filePaths)
 
         # Write data
-        with open(stagingFilePath, "w", encoding = "utf-8") as stagingFileIO:
-            for f in mergedFilePaths:
-                if ".easygit" in f:
-                    continue
-                stagingFileIO.write(f"{f}\n")
+        writeStagingFile(stagingFilePath, mergedFilePaths)
 
     def remove(self, targetFilenames: list[str]) -> None:
         """Remove file(s) from the staging area"""
-        def getAllChildFiles(__targetFolderPath__: os.PathLike) -> list[os.PathLike]:
-            filePaths = []
-            for path in os.listdir(__targetFolderPath__):
-                item = os.path.join(__targetFolderPath__, path)
-                if os.path.isfile(item):
-                    filePaths.append(item)
-                    self.logger.debug(f"[{getTime()}] File located: {item}")
-                elif os.path.isdir(item) and item != os.path.join(__targetFolderPath__, ".easygit"):
-                    filePaths.extend(getAllChildFiles(item))
-            return filePaths
-
-        self.logger.debug(f"[{getTime()}] function remove executed")
+        self.logger.debug("function remove executed")
 
         # Get staging area file
         stagingFilePath = os.path.join(self.repoPath, "stagingCache")
 
         # Return if staging area doesn't exist
         if not os.path.exists(stagingFilePath):
-            self.logger.error(f"[{getTime()}] staging file not found")
+            self.logger.error("staging file not found")
             return
 
         # Get path(s)
         if "." in targetFilenames:
-            filePaths = getAllChildFiles(self.currentPath)
+            filePaths = list(getAllChildFiles(self.currentPath))
+            self.logger.debug("Located %d file(s)", len(filePaths))
         else:
             filePaths = []
             for filename in targetFilenames:
                 currentFilePath = convertToPath(filename)
                 if currentFilePath is None:
-                    self.logger.warning(f"[{getTime()}] Cannot find file: {currentFilePath}, ignoring...")
+                    self.logger.warning("Cannot find file: %s, ignoring...", filename)
                     continue
-                self.logger.debug(f"[{getTime()}] Removed file: {currentFilePath}")
+                self.logger.debug("Removed file: %s", currentFilePath)
                 filePaths.append(currentFilePath)
 
         # Remove paths
         originalFilePaths = set()
         with open(stagingFilePath, "r", encoding = "utf-8") as stagingFileIO:
-            for f in stagingFileIO.readlines():
-                originalFilePaths.add(f.strip("\n"))
+            for f in stagingFileIO:
+                originalFilePaths.add(f.rstrip("\n"))
         for f in filePaths:
             try:
                 originalFilePaths.remove(f)
             except KeyError:
-                self.logger.warning(f"[{getTime()}] File isn\'t included in staging area: {f}")
+                self.logger.warning("File isn\'t included in staging area: %s", f)
 
         # Write data
         if len(originalFilePaths):
-            with open(stagingFilePath, "w", encoding = "utf-8") as stagingFileIO:
-                for f in originalFilePaths:
-                    stagingFileIO.write(f"{f}\n")
+            writeStagingFile(stagingFilePath, originalFilePaths)
         else:
             os.remove(stagingFilePath)
 
     def commit(self, message: list[str]) -> None:
         """Commit change(s) of the file(s) in the staging area"""
-        self.logger.debug(f"[{getTime()}] function commit executed")
+        blobFolderPrefix = self.changeFolderPath + os.sep # Joined once, blob paths are concatenated per file
+
+        hashCache = {} # Rebuilt from the staged files only, so entries of unstaged files are dropped
+
+        def snapshot(filePath: str) -> str:
+            # Reuse the cached SHA if the file's stat is unchanged and its blob is stored
+            # A file modified no earlier than the cache was written may have changed again within the same timestamp, so it is rehashed
+            fileStat = os.stat(filePath)
+            fileKey = [fileStat.st_mtime_ns, fileStat.st_ctime_ns, fileStat.st_ino, fileStat.st_size]
+            cachedEntry = self.hashCache.get(filePath)
+            if cachedEntry is not None and cachedEntry[:-1] == fileKey and fileStat.st_mtime_ns < self.hashCacheTime:
+                fileSHA = cachedEntry[-1]
+                if os.path.exists(blobFolderPrefix + fileSHA[:2] + os.sep + fileSHA[2:]):
+                    hashCache[filePath] = cachedEntry
+                    return f"{filePath}:::{fileSHA}\n"
+
+            # Hash the file in place, content that is already stored needs no write at all
+            with open(filePath, "rb") as fileIO:
+                fileSHA = SHA1_file(fileIO)
+            hashCache[filePath] = fileKey + [fileSHA]
+            if os.path.exists(blobFolderPrefix + fileSHA[:2] + os.sep + fileSHA[2:]):
+                return f"{filePath}:::{fileSHA}\n"
+
+            # Copy, then hash the copy, so a blob always matches its SHA even if the file changes meanwhile
+            tempFileDescriptor, tempFilePath = tempfile.mkstemp(suffix = ".tmp", dir = self.changeFolderPath) # Unique across threads & processes
+            os.close(tempFileDescriptor)
+            try:
+                shutil.copyfile(filePath, tempFilePath) # copyfile lets the kernel move the data
+                with open(tempFilePath, "rb") as tempFileIO:
+                    fileSHA = SHA1_file(tempFileIO)
+                hashCache[filePath] = fileKey + [fileSHA]
+
+                # Keep the copy only if no blob with the same content is stored yet
+                blobFolderPath = blobFolderPrefix + fileSHA[:2]
+                blobPath = blobFolderPath + os.sep + fileSHA[2:]
+                if not os.path.exists(blobPath):
+                    os.makedirs(blobFolderPath, exist_ok = True)
+                    os.replace(tempFilePath, blobPath)
+            finally:
+                # Never leave the copy in the blob pool, unless it was moved into place
+                if os.path.exists(tempFilePath):
+                    os.remove(tempFilePath)
+
+            # Link in commit
+            return f"{filePath}:::{fileSHA}\n"
+
+        self.logger.debug("function commit executed")
 
         # Get staging area file
         stagingFilePath = os.path.join(self.repoPath, "stagingCache")
 
         # Return if staging area doesn't exist
         if not os.path.exists(stagingFilePath):
-            self.logger.error(f"[{getTime()}] staging file not found")
+            self.logger.error("staging file not found")
             return
 
         # Get file paths
-        targetFilePaths = set()
         with open(stagingFilePath, "r", encoding = "utf-8") as stagingFileIO:
-            for f in stagingFileIO.readlines():
-                targetFilePaths.add(f.strip("\n"))
+            targetFilePaths = list(dict.fromkeys(f.rstrip("\n") for f in stagingFileIO if f.strip())) # Deduplicate in a single pass, keeping order
 
         # Get the SHA of last commit
         with open(self.headFile, "r", encoding = "utf-8") as headIO:
             lastCommitSHA = headIO.read()
 
-        # Get the SHA of current commit
-        currentCommitSHA = SHA1(getTime() + "".join(stagingFilePath))
+        # Hash & store files concurrently, file I/O and hashing release the GIL
+        with ThreadPoolExecutor() as executor:
+            manifest = list(executor.map(snapshot, targetFilePaths))
+
+        # Get the SHA of current commit, the parent & the content keep it unique within the same second
+        header = f"HEAD:{lastCommitSHA}\n" # First line: SHA of last commit
+        header += f"Commitment Message:\n=====\n{'\n'.join(message)}\n=====\n"
+        currentCommitSHA = SHA1_bytes(getTime().encode(), header.encode(), "".join(manifest).encode())
+
+        # Commit, never overwrite an existing commit
+        try:
+            with open(os.path.join(self.commitFolderPath, currentCommitSHA), "x", encoding = "utf-8") as commitIO:
+                commitIO.write(header)
+                commitIO.writelines(manifest)
+        except FileExistsError:
+            self.logger.error("Commit %s already exists, exiting...", currentCommitSHA)
+            return
 
-        # Write the SHA of current commit into head
+        # Write the SHA of current commit into head, only once the commit file is complete
         with open(self.headFile, "w", encoding = "utf-8") as headIO:
             headIO.write(currentCommitSHA)
 
-        # Make directory to store changes
-        os.mkdir(os.path.join(self.changeFolderPath, currentCommitSHA))
-
-        # Commit
-        with open(os.path.join(self.commitFolderPath, currentCommitSHA), "w", encoding = "utf-8") as commitIO:
-            commitIO.write(f"HEAD:{lastCommitSHA}\n") # First line: SHA of last commit
-            commitIO.write(f"Commitment Message:\n=====\n{'\n'.join(message)}\n=====\n")
-            for f in targetFilePaths:
-                with open(f, "r", encoding = "utf-8") as fileIO:
-                    content = fileIO.read()
-
-                    # Get SHA of current file
-                    fileSHA = SHA1(f+content)
-
-                    # Write
-                    with open(os.path.join(self.changeFolderPath, currentCommitSHA, fileSHA), "w", encoding = "utf-8") as fileChangeIO:
-                        fileChangeIO.write(content)
-
-                # Write link in commit
-                commitIO.write(f"{f}:::{fileSHA}\n")
+        # Write hash cache
+        self.hashCache = hashCache
+        with open(self.hashCacheFile, "w", encoding = "utf-8") as hashCacheIO:
+            json.dump(self.hashCache, hashCacheIO)
 
     def restore(self, _targetCommitSHA: str = None) -> None:
-        """"""
-        self.logger.debug(f"[{getTime()}] function restore executed")
+        """Restore the file(s) recorded in the target commit"""
+        self.logger.debug("function restore executed")
 
         if _targetCommitSHA is None:
             # Get last commit's SHA if target is None
@@ -207,7 +250,7 @@ class easyGit:
 
             if targetCommitSHA == "":
                 # Exit if there's no recorded commitment
-                self.logger.error(f"[{getTime()}] There\'s no any recorded commitment, exiting...")
+                self.logger.error("There\'s no any recorded commitment, exiting...")
                 return
         else:
             targetCommitSHA = _targetCommitSHA
@@ -215,70 +258,66 @@ class easyGit:
         # Exit if commitment not found
         targetCommitSHAFile = os.path.join(self.commitFolderPath, targetCommitSHA)
         if not os.path.exists(targetCommitSHAFile):
-            self.logger.error(f"[{getTime()}] Target commitment not found, exiting...")
+            self.logger.error("Target commitment not found, exiting...")
             return
 
         with open(targetCommitSHAFile, "r", encoding = "utf-8") as targetCommitSHAIO:
-            content = [l.strip("\n") for l in targetCommitSHAIO.readlines()]
+            content = [l.rstrip("\n") for l in targetCommitSHAIO]
             topIndex = content.index("=====")
-            startIndex = topIndex + content.index("=====", topIndex + 1)
+            startIndex = content.index("=====", topIndex + 1) + 1
+
+        # Restore
+        blobFolderPrefix = self.changeFolderPath + os.sep
+        changeFolderPrefix = os.path.join(self.changeFolderPath, targetCommitSHA) + os.sep
         for fileSet in content[startIndex::]:
-            print(fileSet.split(":::"))
             filePath, fileSHA = fileSet.split(":::")
             os.makedirs(os.path.dirname(filePath), exist_ok = True)
-            with open(os.path.join(self.changeFolderPath, targetCommitSHA, fileSHA), "r", encoding = "utf-8") as originalFileIO:
-                with open(filePath, "w", encoding = "utf-8") as fileIO:
-                    fileIO.write(originalFileIO.read())
+            blobPath = blobFolderPrefix + fileSHA[:2] + os.sep + fileSHA[2:]
+            if not os.path.exists(blobPath):
+                # Commits made before blobs were pooled keep them in their own folder
+                blobPath = changeFolderPrefix + fileSHA
+            shutil.copyfile(blobPath, filePath)
 
 
 
     def status(self, targetSHA: str = None, maxDepth: int = 5) -> None:
         """Get the status of the targetSHA"""
-        self.logger.debug(f"[{getTime()}] function status executed")
-        result = self.search(targetSHA, 0, maxDepth)
-        self.logger.info(f"[{getTime()}] {result[0]} <- HEAD")
+        self.logger.debug("function status executed")
+        result = self.search(targetSHA, maxDepth)
+        if result is None:
+            return
+        self.logger.info("%s <- HEAD", result[0])
         if len(result) > 1:
             for SHA in result[1::]:
-                self.logger.info(f"[{getTime()}] {SHA}")
-
-    def search(self, targetSHA: str = None, depth: int = 0, maxDepth: int = 5) -> None:
-        if depth >= maxDepth:
-            return
+                self.logger.info("%s", SHA)
 
+    def search(self, targetSHA: str = None, maxDepth: int = 5) -> list[str] | None:
+        """Return the SHA of the target commit followed by the SHA of its ancestors, up to maxDepth commits"""
         if targetSHA is None:
             # Get last commit's SHA if target is None
             with open(self.headFile, "r", encoding = "utf-8") as headIO:
-                targetCommitSHA = headIO.read().strip("\n")
+                targetSHA = headIO.read().strip("\n")
 
-            if targetCommitSHA == "":
+            if targetSHA == "":
                 # Exit if there's no recorded commitment
-                self.logger.error(f"[{getTime()}] There\'s no any recorded commitment, exiting...")
-                return
-            else:
-                # Search from head
-                return self.search(targetCommitSHA, 0, maxDepth)
-        else:
+                self.logger.error("There\'s no any recorded commitment, exiting...")
+                return None
+
+        result = []
+        while targetSHA != "" and len(result) < maxDepth:
             targetSHAFile = os.path.join(self.commitFolderPath, targetSHA)
 
             # Check if the file exists
             if not os.path.exists(targetSHAFile):
-                self.logger.error(f"[{getTime()}] Target commit doesn\'t exist, exiting...")
-                return
+                self.logger.error("Target commit doesn\'t exist, exiting...")
+                break
+            result.append(targetSHA)
 
-            # Get target commit's SHA
+            # Get the SHA of the previous commit
             with open(targetSHAFile, "r", encoding = "utf-8") as lastCommitSHAIO:
-                lastCommitSHA = lastCommitSHAIO.readline().strip("\n").split(":")[-1]
+                targetSHA = lastCommitSHAIO.readline().strip("\n").split(":")[-1]
 
-            if lastCommitSHA != "":
-                recursion = self.search(lastCommitSHA, depth+1, maxDepth)
-            else:
-                recursion = None
-
-            # Weird recusion
-            if recursion is None:
-                return [targetSHA]
-            else:
-                return [targetSHA] + recursion
+        return result or None
 
 
 def initialization() -> None:
@@ -300,8 +339,8 @@ def initialization() -> None:
     changesFolderPath = os.path.join(repoFolderPath, "changes")
     commitFolderPath = os.path.join(repoFolderPath, "commit")
     logFolderPath = os.path.join(repoFolderPath, "log")
-    for p in [repoFolderPath, changesFolderPath, commitFolderPath, logFolderPath]:
-        os.mkdir(p)
+    for p in [changesFolderPath, commitFolderPath, logFolderPath]:
+        os.makedirs(p, exist_ok = True)
 
     # Make configuration file
     config = configparser.ConfigParser(allow_no_value = True)
@@ -313,30 +352,47 @@ def initialization() -> None:
 
     # Make Head & Log
     for f in [os.path.join(commitFolderPath, "HEAD"), os.path.join(logFolderPath, "log.log")]:
-        with open(f, "w", encoding = "utf-8") as headIO:
-            pass
+        Path(f).touch()
 
 def getRepositoryPath(targetPath: os.PathLike | str) -> os.PathLike | None:
     """Return the .easygit folder path if it exists in the current folder or any of the parent folders; otherwise return None"""
-    currentFolder = convertToPath(targetPath)
+    currentFolder = Path(os.path.abspath(targetPath))
 
-    if not os.path.exists(currentFolder):
-        return None
+    # Check the current folder first, then every parent folder up to the disk folder
+    for folder in (currentFolder, *currentFolder.parents):
+        repoPath = folder / ".easygit"
+        if repoPath.is_dir(): # Found .easygit
+            return os.fspath(repoPath)
+    return None
 
-    repoPath = os.path.join(currentFolder, ".easygit") # Check if .easygit exists in the current folder
-    if os.path.isdir(repoPath): # Found .easygit
-        return convertToPath(repoPath)
-    elif currentFolder == os.path.dirname(currentFolder): # Return none when current folder is disk folder
-        return None
-    else:
-        return getRepositoryPath(os.path.dirname(currentFolder)) # Recurse if .easygit is not found
+def writeStagingFile(stagingFilePath: str, filePaths: Iterable[str]) -> None:
+    """Replace the staging file with the given paths atomically, a crash never leaves it half written"""
+    tempFilePath = f"{stagingFilePath}.tmp"
+    with open(tempFilePath, "w", encoding = "utf-8") as stagingFileIO:
+        stagingFileIO.write("".join(f"{f}\n" for f in filePaths))
+    os.replace(tempFilePath, stagingFilePath)
+
+def isRepositoryPath(targetPath: str) -> bool:
+    """Return True if the path is a .easygit folder or inside one; names merely containing .easygit don't count"""
+    return f"{os.sep}.easygit{os.sep}" in f"{targetPath}{os.sep}"
+
+def getAllChildFiles(targetFolderPath: os.PathLike | str) -> Iterator[str]:
+    """Yield the path of every file under the target folder, skipping .easygit folders"""
+    with os.scandir(targetFolderPath) as entries:
+        for entry in entries:
+            if entry.name == ".easygit":
+                continue
+            if entry.is_file():
+                yield entry.path
+            elif entry.is_dir(follow_symlinks = False):
+                yield from getAllChildFiles(entry.path)
 
 def convertToPath(targetPath: os.PathLike | str) -> os.PathLike | None:
     """Convert any path-like object or string into path object"""
     if isinstance(targetPath, os.PathLike):
-        p = targetPath
+        p = os.fspath(targetPath)
     elif isinstance(targetPath, str):
-        p = os.path.abspath(targetPath)
+        p = os.path.normpath(targetPath) if os.path.isabs(targetPath) else os.path.abspath(targetPath) # Skip getcwd for absolute paths
     else:
         raise TypeError
 
@@ -346,7 +402,18 @@ def convertToPath(targetPath: os.PathLike | str) -> os.PathLike | None:
 
 def SHA1(target: str) -> str:
     """Return SHA1 of the target string"""
-    return hashlib.sha1(target.encode()).hexdigest()
+    return SHA1_bytes(target.encode())
+
+def SHA1_bytes(*parts: bytes) -> str:
+    """Return SHA1 of the concatenation of the given byte parts, without concatenating them"""
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part)
+    return h.hexdigest()
+
+def SHA1_file(fileHandle) -> str:
+    """Return SHA1 of the content of the binary file handle"""
+    return hashlib.file_digest(fileHandle, "sha1").hexdigest()
 
 def getTime() -> str:
     """Return the time now by the format \"%Y%m%d %H-%M-%S\""""
@@ -354,7 +421,7 @@ def getTime() -> str:
 
 
 def main() -> None:
-    logging.basicConfig(level = logging.DEBUG)
+    logging.basicConfig(level = logging.DEBUG, format = "%(levelname)s:%(name)s:[%(asctime)s] %(message)s", datefmt = "%Y%m%d %H-%M-%S")
     argParser = argparse.ArgumentParser(description = "Easy Git")
     subParser = argParser.add_subparsers(dest = "command", help = "Available commands", required = True)
 